@@ -1,10 +1,16 @@
+import asyncio
+import copy
+import hashlib
+import io
 import os
-import re
 import time
-import smtplib
-import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from email.message import EmailMessage
+from functools import lru_cache
+from itertools import islice
 
+import aiosmtplib
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -27,15 +33,53 @@ GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD", "").strip()
 IDLE_SLEEP_SECONDS = 2 * 60 * 60  # 2h
 SUPPORTED_EXT = (".epub",)
 
+# Reused SMTP connection (Gmail handshake + AUTH is expensive, so keep it alive)
+SMTP_IDLE_CLOSE_SECONDS = 5 * 60  # Gmail drops idle connections anyway
+_smtp_lock = asyncio.Lock()
+_smtp_conn = None
+_smtp_idle_handle = None  # pending close of an unused connection
+
 # =========================
 # GLOBAL STATE
 # =========================
-kindle_mode = False
-received = 0
-sent_ok = 0
-sent_fail = 0
-errors = []
-last_activity = time.time()
+@dataclass(slots=True)
+class BotState:
+    kindle_mode: bool = False
+    received: int = 0
+    sent_ok: int = 0
+    sent_fail: int = 0
+    # bounded; summaries only show the first few
+    errors: deque = field(default_factory=lambda: deque(maxlen=50))
+    last_activity: float = field(default_factory=time.time)
+
+    def reset_counters(self):
+        self.received = 0
+        self.sent_ok = 0
+        self.sent_fail = 0
+        self.errors.clear()
+
+
+state = BotState()
+
+# Guards counter/error updates and the snapshot+reset in the summaries,
+# so concurrent document handlers can't interleave with a reset
+_state_lock = asyncio.Lock()
+
+# Recently sent books (sha256 digest -> timestamp), so accidental
+# double-sends don't go through a whole SMTP transaction again.
+# _pending_sends covers books still queued or mid-send, which _recent_sends
+# only learns about once the SMTP transaction succeeds.
+_RECENT_SENDS_MAX = 32
+_recent_sends = OrderedDict()
+_pending_sends = set()
+
+# Pending sends; a single worker drains this so bursts of books are
+# delivered back to back over one SMTP connection
+_send_queue = asyncio.Queue()
+_sender_task = None  # worker task, started in _post_init, cancelled in _post_stop
+
+_application = None  # set in main(), used by the idle auto-stop
+_idle_handle = None  # pending asyncio.TimerHandle for the idle auto-stop
 
 
 def ensure_env():
@@ -55,9 +99,10 @@ def ensure_env():
         raise RuntimeError("Missing environment variables: " + ", ".join(missing))
 
 
-def is_owner(update: Update) -> bool:
+def is_owner(update: Update, _owner=ALLOWED_USER_ID) -> bool:
+    # Default-arg binding keeps the owner id a local lookup on the hot path
     user = update.effective_user
-    return bool(user and user.id == ALLOWED_USER_ID)
+    return user is not None and user.id == _owner
 
 
 async def deny_if_not_owner(update: Update) -> bool:
@@ -70,73 +115,202 @@ async def deny_if_not_owner(update: Update) -> bool:
 
 
 def touch():
-    global last_activity
-    last_activity = time.time()
+    global _idle_handle
+    state.last_activity = time.time()
+
+    # Reschedule the one-shot idle timer instead of polling in a thread
+    if _idle_handle is not None:
+        _idle_handle.cancel()
+        _idle_handle = None
+    if state.kindle_mode:
+        loop = asyncio.get_running_loop()
+        _idle_handle = loop.call_later(IDLE_SLEEP_SECONDS, _auto_stop)
+
+
+def _cancel_idle_timer():
+    global _idle_handle
+    if _idle_handle is not None:
+        _idle_handle.cancel()
+        _idle_handle = None
 
 
+_TITLE_TRANS = str.maketrans({"_": " ", "-": " "})
+
+
+@lru_cache(maxsize=256)
 def prettify_title(filename: str) -> str:
-    name = filename
-    for ext in SUPPORTED_EXT:
-        if name.lower().endswith(ext):
-            name = name[: -len(ext)]
-            break
-    name = name.replace("_", " ").replace("-", " ")
-    name = re.sub(r"\s+", " ", name).strip()
-    return name
-
-
-def send_email_to_kindle(file_bytes: bytes, filename: str):
-    msg = EmailMessage()
-    msg["From"] = GMAIL_ADDRESS
-    msg["To"] = KINDLE_EMAIL
-    msg["Subject"] = "Send to Kindle"
-    msg.set_content("Enviado pelo BOT Kindlinho 🫶🏻")
+    # Only lowercase the suffix; no need to copy the whole name
+    if filename[-5:].lower() == ".epub":
+        filename = filename[:-5]
+    # split() with no args already collapses runs of whitespace
+    return " ".join(filename.translate(_TITLE_TRANS).split())
+
+
+async def _get_smtp_conn():
+    """Return a live, authenticated SMTP connection (reconnecting if needed).
+
+    Must be called with _smtp_lock held.
+    """
+    global _smtp_conn
+
+    if _smtp_conn is not None:
+        try:
+            response = await _smtp_conn.noop()
+            if response.code == 250:
+                return _smtp_conn
+        except Exception:
+            pass
+        await _close_smtp_conn()
+
+    conn = aiosmtplib.SMTP(hostname="smtp.gmail.com", port=465, use_tls=True)
+    await conn.connect()
+    await conn.login(GMAIL_ADDRESS, GMAIL_APP_PASSWORD)
+    _smtp_conn = conn
+    return conn
+
+
+async def _close_smtp_conn():
+    global _smtp_conn
+
+    if _smtp_conn is not None:
+        try:
+            await _smtp_conn.quit()
+        except Exception:
+            pass
+        _smtp_conn = None
+
+
+def _reschedule_smtp_idle_close():
+    """Arm the idle close so an unused connection doesn't hit Gmail's drop."""
+    global _smtp_idle_handle
+
+    if _smtp_idle_handle is not None:
+        _smtp_idle_handle.cancel()
+    loop = asyncio.get_running_loop()
+    _smtp_idle_handle = loop.call_later(
+        SMTP_IDLE_CLOSE_SECONDS,
+        lambda: asyncio.get_running_loop().create_task(_close_idle_smtp_conn()),
+    )
+
+
+async def _close_idle_smtp_conn():
+    global _smtp_idle_handle
+
+    _smtp_idle_handle = None
+    async with _smtp_lock:
+        await _close_smtp_conn()
+
+
+# Constant headers/body parsed once; each send only adds the attachment
+_MSG_TEMPLATE = EmailMessage()
+_MSG_TEMPLATE["From"] = GMAIL_ADDRESS
+_MSG_TEMPLATE["To"] = KINDLE_EMAIL
+_MSG_TEMPLATE["Subject"] = "Send to Kindle"
+_MSG_TEMPLATE.set_content("Enviado pelo BOT Kindlinho 🫶🏻")
+
 
+async def send_email_to_kindle(file_bytes, filename: str):
+    """Send one EPUB to the Kindle address. file_bytes is any bytes-like object."""
+    msg = copy.deepcopy(_MSG_TEMPLATE)
     msg.add_attachment(
         file_bytes,
         maintype="application",
         subtype="epub+zip",
         filename=filename,
+        cte="base64",  # routes through the C-level binascii encoder
     )
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(GMAIL_ADDRESS, GMAIL_APP_PASSWORD)
-        smtp.send_message(msg)
+    async with _smtp_lock:
+        try:
+            smtp = await _get_smtp_conn()
+            await smtp.send_message(msg)
+            await smtp.rset()
+            _reschedule_smtp_idle_close()
+        except Exception:
+            # Drop the connection so the next send starts fresh
+            await _close_smtp_conn()
+            raise
+
+
+async def _sender_worker():
+    """Drain queued books, keeping bursts on one SMTP connection."""
+    while True:
+        item = await _send_queue.get()
+        while item is not None:
+            try:
+                await _process_send(*item)
+            except Exception:
+                pass
+
+            # Wait briefly for the next book of the burst before idling
+            try:
+                item = await asyncio.wait_for(_send_queue.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                item = None
+
+
+async def _process_send(file_bytes, filename, digest, message):
+    try:
+        await send_email_to_kindle(file_bytes, filename)
+    except Exception as e:
+        # Forget the pending digest so a failed book can be retried
+        _pending_sends.discard(digest)
+        async with _state_lock:
+            state.sent_fail += 1
+            state.errors.append(f"{filename}: falha ao enviar email ({e})")
+        await message.reply_text(f"❌ Erro ao enviar para Kindle: {filename}")
+        return
+
+    # Promote pending -> recently sent now that the book is delivered
+    _pending_sends.discard(digest)
+    _recent_sends[digest] = time.time()
+    while len(_recent_sends) > _RECENT_SENDS_MAX:
+        _recent_sends.popitem(last=False)
+
+    async with _state_lock:
+        state.sent_ok += 1
+
+    title = prettify_title(filename)
+    await message.reply_text(f"✅ Livro {title} foi enviado para o Kindlinho 🫶🏻")
 
 
-def idle_monitor_thread(app: Application):
+def _auto_stop():
+    """Idle timer callback; hands off to a task so it can take the state lock."""
+    global _idle_handle
+
+    _idle_handle = None
+    asyncio.get_running_loop().create_task(_auto_stop_task())
+
+
+async def _auto_stop_task():
     """Auto stop after 2 hours idle while in kindle mode."""
-    global kindle_mode, received, sent_ok, sent_fail, errors
+    async with _state_lock:
+        if not state.kindle_mode:
+            return
 
-    while True:
-        time.sleep(30)
+        state.kindle_mode = False
+
+        summary = (
+            "😴 Sem atividade há 2h.\n"
+            "Modo Kindle desativado 🫶🏻\n\n"
+            f"📥 Recebidos: {state.received}\n"
+            f"✅ Enviados com sucesso: {state.sent_ok}\n"
+            f"❌ Erros: {state.sent_fail}"
+        )
 
-        if kindle_mode:
-            idle = time.time() - last_activity
-            if idle >= IDLE_SLEEP_SECONDS:
-                kindle_mode = False
+        if state.errors:
+            summary += "\n\n⚠️ Erros:\n" + "\n".join(f"• {e}" for e in islice(state.errors, 10))
 
-                summary = (
-                    "😴 Sem atividade há 2h.\n"
-                    "Modo Kindle desativado 🫶🏻\n\n"
-                    f"📥 Recebidos: {received}\n"
-                    f"✅ Enviados com sucesso: {sent_ok}\n"
-                    f"❌ Erros: {sent_fail}"
-                )
+        state.reset_counters()
 
-                if errors:
-                    summary += "\n\n⚠️ Erros:\n" + "\n".join(f"• {e}" for e in errors[:10])
+    await _send_summary(summary)
 
-                # reset
-                received = 0
-                sent_ok = 0
-                sent_fail = 0
-                errors = []
 
-                try:
-                    app.bot.send_message(chat_id=ALLOWED_USER_ID, text=summary)
-                except:
-                    pass
+async def _send_summary(summary: str):
+    try:
+        await _application.bot.send_message(chat_id=ALLOWED_USER_ID, text=summary)
+    except Exception:
+        pass
 
 
 # =========================
@@ -155,17 +329,13 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_kindle(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global kindle_mode, received, sent_ok, sent_fail, errors
-
     if await deny_if_not_owner(update):
         return
 
-    touch()
-    kindle_mode = True
-    received = 0
-    sent_ok = 0
-    sent_fail = 0
-    errors = []
+    async with _state_lock:
+        state.kindle_mode = True
+        touch()
+        state.reset_counters()
 
     await update.message.reply_text(
         "Modo Kindle ativo ✅\n"
@@ -174,36 +344,33 @@ async def cmd_kindle(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global kindle_mode, received, sent_ok, sent_fail, errors
-
     if await deny_if_not_owner(update):
         return
 
     touch()
 
-    if not kindle_mode:
-        await update.message.reply_text("Eu já estava em descanso 🫶🏻")
-        return
+    async with _state_lock:
+        if not state.kindle_mode:
+            await update.message.reply_text("Eu já estava em descanso 🫶🏻")
+            return
 
-    kindle_mode = False
+        state.kindle_mode = False
+        _cancel_idle_timer()
 
-    msg = (
-        "Modo Kindle desativado 🫶🏻\n\n"
-        f"📥 Recebidos: {received}\n"
-        f"✅ Enviados com sucesso: {sent_ok}\n"
-        f"❌ Erros: {sent_fail}"
-    )
+        msg = (
+            "Modo Kindle desativado 🫶🏻\n\n"
+            f"📥 Recebidos: {state.received}\n"
+            f"✅ Enviados com sucesso: {state.sent_ok}\n"
+            f"❌ Erros: {state.sent_fail}"
+        )
 
-    if errors:
-        msg += "\n\n⚠️ Erros:\n" + "\n".join(f"• {e}" for e in errors[:10])
+        if state.errors:
+            msg += "\n\n⚠️ Erros:\n" + "\n".join(f"• {e}" for e in islice(state.errors, 10))
 
-    msg += "\n\nAté já 📚✨"
+        msg += "\n\nAté já 📚✨"
 
-    # reset counters after summary
-    received = 0
-    sent_ok = 0
-    sent_fail = 0
-    errors = []
+        # reset counters after summary
+        state.reset_counters()
 
     await update.message.reply_text(msg)
 
@@ -212,55 +379,89 @@ async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # DOCUMENT HANDLER
 # =========================
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global received, sent_ok, sent_fail, errors
-
     if await deny_if_not_owner(update):
         return
 
     touch()
 
-    if not kindle_mode:
+    if not state.kindle_mode:
         await update.message.reply_text("Antes disso usa /kindle para eu começar a enviar 📚")
         return
 
     doc = update.message.document
     filename = doc.file_name or "livro.epub"
 
-    if not filename.lower().endswith(SUPPORTED_EXT):
+    fn_low = filename.lower()
+    if not fn_low.endswith(SUPPORTED_EXT):
         await update.message.reply_text("Esse ficheiro não é EPUB 😅\nEnvia um .epub e eu trato do resto.")
         return
 
-    received += 1
+    async with _state_lock:
+        state.received += 1
 
     # Download file
     try:
         tg_file = await context.bot.get_file(doc.file_id)
-        file_bytes = await tg_file.download_as_bytearray()
+        buf = io.BytesIO()
+        await tg_file.download_to_memory(buf)
+        # Zero-copy view; buf stays referenced until the send finishes
+        file_bytes = buf.getbuffer()
     except Exception as e:
-        sent_fail += 1
-        errors.append(f"{filename}: falha a descarregar ({e})")
+        async with _state_lock:
+            state.sent_fail += 1
+            state.errors.append(f"{filename}: falha a descarregar ({e})")
         await update.message.reply_text(f"❌ Erro ao descarregar: {filename}")
         return
 
-    # Send email
-    try:
-        send_email_to_kindle(bytes(file_bytes), filename)
-        sent_ok += 1
-        title = prettify_title(filename)
-        await update.message.reply_text(f"✅ Livro {title} foi enviado para o Kindlinho 🫶🏻")
-    except Exception as e:
-        sent_fail += 1
-        errors.append(f"{filename}: falha ao enviar email ({e})")
-        await update.message.reply_text(f"❌ Erro ao enviar para Kindle: {filename}")
+    # Skip books already delivered or still on their way out
+    # (double-send / retry of a success)
+    digest = hashlib.sha256(file_bytes).digest()
+    if digest in _pending_sends or digest in _recent_sends:
+        if digest in _recent_sends:
+            _recent_sends.move_to_end(digest)
+        await update.message.reply_text("Já enviei este livro há pouco 🫶🏻")
+        return
+
+    # Queue for the sender worker; books in a burst share one SMTP session
+    _pending_sends.add(digest)
+    await _send_queue.put((file_bytes, filename, digest, update.message))
 
 
 # =========================
 # MAIN
 # =========================
+async def _post_init(application: Application):
+    # Plain asyncio task: Application.stop() awaits tasks made via
+    # application.create_task, and the worker loops forever
+    global _sender_task
+    _sender_task = asyncio.create_task(_sender_worker())
+
+
+async def _post_stop(application: Application):
+    global _sender_task
+
+    if _sender_task is not None:
+        _sender_task.cancel()
+        try:
+            await _sender_task
+        except asyncio.CancelledError:
+            pass
+        _sender_task = None
+
+
 def main():
+    global _application
+
     ensure_env()
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .build()
+    )
+    _application = application
 
     application.add_handler(CommandHandler("start", cmd_start))
     application.add_handler(CommandHandler("kindle", cmd_kindle))
@@ -268,9 +469,6 @@ def main():
 
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
 
-    # Start idle monitor (thread)
-    threading.Thread(target=idle_monitor_thread, args=(application,), daemon=True).start()
-
     # Start polling
     application.run_polling()
 